@@ -4,12 +4,31 @@ Production-ready with environment variables - Backend Only
 """
 
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.utils import secure_filename
 import os
-import json
+import io
+import logging
+import orjson
+import time
+import uuid
+import asyncio
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import google.generativeai as genai
-from PIL import Image
+from google.generativeai.client import FileServiceClient, GENAI_API_DISCOVERY_URL
+from google.generativeai.types import file_types
+from google.api_core import exceptions as google_exceptions
+import googleapiclient.discovery
+import httplib2
+from googleapiclient.errors import HttpError
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception, before_sleep_log
+from PIL import Image, ImageOps
 from pdf2image import convert_from_path
 import re
 from dotenv import load_dotenv
@@ -17,6 +36,12 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    format='%(asctime)s %(levelname)s %(message)s'
+)
+logger = logging.getLogger(__name__)
+
 # Configuration - Using environment variables
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 
@@ -28,7 +53,28 @@ if not GEMINI_API_KEY:
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Uploads outside these are rejected before they are rendered. Many clients
+# (e.g. requests' files=) send no part Content-Type, so an empty or generic
+# declared type is treated as unknown and the file's magic bytes decide.
+ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.pdf'}
+ALLOWED_MIMETYPES = {'image/jpeg', 'image/png', 'image/webp', 'application/pdf'}
+UNKNOWN_MIMETYPES = {'', 'application/octet-stream'}
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (keeps Flask's sorted-keys output)"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=orjson.OPT_SORT_KEYS), mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)  # Enable CORS for all routes
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
@@ -37,23 +83,333 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 genai.configure(api_key=GEMINI_API_KEY)
 gemini_model = genai.GenerativeModel('gemini-2.5-flash')
 
+# Max in-flight Gemini calls per worker process (respects API rate limits)
+GEMINI_CONCURRENCY = int(os.environ.get('GEMINI_CONCURRENCY', 8))
+
+# One long-lived event loop per worker. The async Gemini client binds its gRPC
+# channel to the loop it was first used on, so every request thread schedules
+# its calls onto this loop instead of creating a fresh one with asyncio.run().
+_event_loop = asyncio.new_event_loop()
+threading.Thread(target=_event_loop.run_forever, name='gemini-loop', daemon=True).start()
+_gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# Pages of a PDF sent to Gemini; later pages are ignored
+MAX_PDF_PAGES = int(os.environ.get('MAX_PDF_PAGES', 10))
+
+# Gemini processes images at a fixed tile resolution, so anything larger on
+# the long edge only costs upload time
+MAX_IMAGE_EDGE = 2000
+
+# Gemini Files API handles keyed by SHA-256 of the uploaded bytes, so repeat
+# scans reuse the server-side copy. Gemini expires files after 48h; entries
+# older than GEMINI_FILE_TTL are re-uploaded, and LRU evictions are deleted.
+GEMINI_FILE_CACHE_SIZE = 128
+GEMINI_FILE_TTL = 47 * 3600
+_uploaded_files = OrderedDict()
+_uploaded_files_lock = threading.Lock()
+# Uploads go through a discovery Resource holding one httplib2.Http, which is
+# not thread-safe, so each thread gets its own Files client instead of
+# sharing genai's process-wide one
+_files_clients = threading.local()
+# genai fetches the Files discovery document lazily through an httplib2.Http
+# with no socket timeout; it is fetched once per process here, with one
+FILES_API_TIMEOUT = 30
+_files_discovery_doc = None
+_files_discovery_lock = threading.Lock()
+# Uploads run on their own pool so they are bounded by GEMINI_CONCURRENCY
+# rather than the event loop's (CPU-sized) default executor
+_files_executor = ThreadPoolExecutor(max_workers=GEMINI_CONCURRENCY, thread_name_prefix='gemini-files')
+
+# Extraction results keyed by (doc_type, SHA-256 of the upload). Each entry is
+# mirrored to a JSON file under CACHE_FOLDER so it survives worker restarts;
+# the in-memory copy is an LRU of RESULT_CACHE_SIZE entries. The files hold
+# customer data, so expired ones are deleted on read and at startup.
+CACHE_FOLDER = 'cache'
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 7 * 24 * 3600))
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 1024))
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
 # ==================== HELPER FUNCTIONS ====================
 
+_MICR_RE = re.compile(r'[⑈⑆]\s*(\d+)\s*[⑈⑆]')
+_MICR_FALLBACK_RE = re.compile(r'\b\d{6}\b')
+_NON_DIGIT_RE = re.compile(r'[^\d]')
+# Body of a ```json ... ``` fenced block in Gemini replies
+_FENCE_RE = re.compile(r'```(?:json)?\s*(\{.*\})\s*```', re.DOTALL)
+# Inserts a comma before every pair of digits (lakh/crore grouping)
+_INDIAN_GROUP_RE = re.compile(r'(\d)(?=(\d\d)+$)')
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared Gemini event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop).result(timeout)
+
+def _files_discovery_document():
+    global _files_discovery_doc
+    with _files_discovery_lock:
+        if _files_discovery_doc is None:
+            http = httplib2.Http(timeout=FILES_API_TIMEOUT)
+            try:
+                resp, content = http.request(f"{GENAI_API_DISCOVERY_URL}?version=v1beta&key={GEMINI_API_KEY}")
+            finally:
+                http.close()
+            if resp.status != 200:
+                raise HttpError(resp, content)
+            _files_discovery_doc = content.decode('utf-8')
+        return _files_discovery_doc
+
+def files_client():
+    """This thread's Gemini Files API client"""
+    client = getattr(_files_clients, 'client', None)
+    if client is None:
+        client = FileServiceClient(client_options={'api_key': GEMINI_API_KEY})
+        # Pre-set the discovery API create_file would otherwise fetch itself;
+        # build_from_document gives it an httplib2.Http with a socket timeout
+        client._discovery_api = googleapiclient.discovery.build_from_document(
+            _files_discovery_document(), developerKey=GEMINI_API_KEY
+        )
+        _files_clients.client = client
+    return client
+
+def _warm_up_files_client():
+    # Fetches the discovery document and opens this upload thread's gRPC
+    # channel; both are bounded by FILES_API_TIMEOUT
+    client = files_client()
+    next(iter(client.list_files({'page_size': 1}, timeout=FILES_API_TIMEOUT)), None)
+
+def warm_up_gemini():
+    """Open the Gemini generate (gRPC) and Files (HTTP) connections before the first request needs them"""
+    try:
+        run_async(gemini_model.count_tokens_async('ping'), timeout=15)
+        logger.info("✓ Gemini connection warmed up")
+    except Exception as e:
+        logger.warning("⚠️ Gemini warm-up failed: %r", e)
+    
+    try:
+        _files_executor.submit(_warm_up_files_client).result(timeout=FILES_API_TIMEOUT + 5)
+        logger.info("✓ Gemini Files API connection warmed up")
+    except Exception as e:
+        logger.warning("⚠️ Gemini Files API warm-up failed: %r", e)
+
+def describe_image(img_or_path):
+    """Short log label for an extractor input: the path, or a PIL image's size and format"""
+    if isinstance(img_or_path, Image.Image):
+        return f"{img_or_path.width}x{img_or_path.height} {img_or_path.format or 'rendered'} image"
+    return img_or_path
+
+def prepare_image_for_gemini(img_or_path):
+    """Downscale an image (path or PIL) and encode it as the JPEG bytes sent to Gemini"""
+    img = img_or_path if isinstance(img_or_path, Image.Image) else Image.open(img_or_path)
+    scale = MAX_IMAGE_EDGE / max(img.size)
+    if img.format == 'JPEG' and scale < 1:
+        # Let libjpeg decode straight to 1/2, 1/4 or 1/8 size; no-op once loaded
+        img.draft('RGB', (int(img.width * scale), int(img.height * scale)))
+    # Re-encoding drops EXIF, so bake the Orientation tag into the pixels first
+    img = ImageOps.exif_transpose(img)
+    if img.has_transparency_data:
+        # Flatten onto white; a bare convert('RGB') turns transparent areas black
+        rgba = img.convert('RGBA')
+        img = Image.new('RGB', rgba.size, 'white')
+        img.paste(rgba, mask=rgba.getchannel('A'))
+    elif img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+    
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=85, optimize=True)
+    return buf.getvalue()
+
+def upload_to_gemini(data):
+    """Upload JPEG bytes via the Gemini Files API, reusing handles for identical bytes"""
+    digest = hashlib.sha256(data).hexdigest()
+    
+    with _uploaded_files_lock:
+        cached = _uploaded_files.get(digest)
+        if cached and time.monotonic() - cached[1] < GEMINI_FILE_TTL:
+            _uploaded_files.move_to_end(digest)
+            return cached[0]
+    
+    file_ref = file_types.File(files_client().create_file(io.BytesIO(data), mime_type='image/jpeg'))
+    
+    evicted = []
+    with _uploaded_files_lock:
+        _uploaded_files[digest] = (file_ref, time.monotonic())
+        _uploaded_files.move_to_end(digest)
+        while len(_uploaded_files) > GEMINI_FILE_CACHE_SIZE:
+            evicted.append(_uploaded_files.popitem(last=False)[1][0])
+    
+    for old_ref in evicted:
+        try:
+            genai.delete_file(old_ref.name)
+        except Exception as e:
+            logger.warning("⚠️ Failed to delete Gemini file %s: %s", old_ref.name, e)
+    
+    return file_ref
+
+def sniff_file_type(head):
+    """Identify an upload from its leading bytes; returns one of ALLOWED_MIMETYPES or None"""
+    if head.startswith(b'%PDF-'):
+        return 'application/pdf'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def _result_cache_path(doc_type, digest):
+    return os.path.join(CACHE_FOLDER, f"{doc_type}_{digest}.json")
+
+def _remember_result(key, entry):
+    with _result_cache_lock:
+        _result_cache[key] = entry
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+def _remove_cache_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("⚠️ Failed to delete cache entry %s: %s", path, e)
+
+def get_cached_result(doc_type, digest):
+    """Return a previously extracted result for this document, or None"""
+    key = (doc_type, digest)
+    path = _result_cache_path(doc_type, digest)
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry is not None:
+            _result_cache.move_to_end(key)
+    
+    if entry is None:
+        try:
+            with open(path, 'rb') as f:
+                entry = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        _remember_result(key, entry)
+    
+    if time.time() - entry['cached_at'] > RESULT_CACHE_TTL:
+        with _result_cache_lock:
+            _result_cache.pop(key, None)
+        _remove_cache_file(path)
+        return None
+    
+    logger.info("⚡ Cache hit for %s: %s", doc_type, digest)
+    return entry['data']
+
+def set_cached_result(doc_type, digest, data):
+    """Store an extracted result in memory and on disk"""
+    entry = {'cached_at': time.time(), 'data': data}
+    _remember_result((doc_type, digest), entry)
+    
+    path = _result_cache_path(doc_type, digest)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(entry))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("⚠️ Failed to persist cache entry %s: %s", path, e)
+
+def prune_result_cache():
+    """Delete cache files older than RESULT_CACHE_TTL (by modification time)"""
+    cutoff = time.time() - RESULT_CACHE_TTL
+    with os.scandir(CACHE_FOLDER) as entries:
+        for entry in entries:
+            try:
+                expired = entry.name.endswith('.json') and entry.stat().st_mtime < cutoff
+            except OSError:
+                continue  # removed by another worker pruning at the same time
+            if expired:
+                _remove_cache_file(entry.path)
+
+prune_result_cache()
+
+def render_pdf_pages(buf, original_name):
+    """Render up to MAX_PDF_PAGES pages of an uploaded PDF (written briefly to UPLOAD_FOLDER for Poppler)"""
+    filename = f"{uuid.uuid4().hex}_{secure_filename(original_name)}"
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    with open(filepath, 'wb') as f:
+        f.write(buf.getbuffer())
+    try:
+        return convert_from_path(filepath, dpi=200, fmt='jpeg', thread_count=4, first_page=1, last_page=MAX_PDF_PAGES)
+    finally:
+        os.remove(filepath)
+
+async def extract_pages(extract_fn, pages):
+    """Run extract_fn over every page concurrently, keeping page order"""
+    return await asyncio.gather(*(extract_fn(page) for page in pages))
+
+def merge_first_non_empty(results):
+    """Combine per-page results, taking each field from the first page that has it (failed pages are None)"""
+    pages = [result for result in results if result]
+    if not pages:
+        return None
+    merged = dict(pages[0])
+    for result in pages[1:]:
+        for key, value in result.items():
+            if value and not merged.get(key):
+                merged[key] = value
+    return merged
+
+def collect_cheques(results):
+    """One cheque per page of a multi-page PDF, keeping a None slot for each page that failed"""
+    return list(results)
+
+def _is_retryable_gemini_error(exc):
+    """Rate limiting (429) or transient unavailability (503) from either Gemini API"""
+    if isinstance(exc, (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable)):
+        return True
+    # The Files API goes through googleapiclient, which raises HttpError instead
+    return isinstance(exc, HttpError) and exc.resp.status in (429, 503)
+
+# Jittered exponential backoff for every Gemini call; the semaphore is taken
+# inside the retried function so it is only held while a call is in flight
+_gemini_retry = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception(_is_retryable_gemini_error),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True
+)
+
+@_gemini_retry
+async def _upload_jpeg_with_gemini(data):
+    async with _gemini_semaphore:
+        return await asyncio.get_running_loop().run_in_executor(_files_executor, upload_to_gemini, data)
+
+async def upload_with_gemini(img_or_path):
+    """Encode an image once, then upload it for Gemini (retried, bounded by GEMINI_CONCURRENCY)"""
+    data = await asyncio.to_thread(prepare_image_for_gemini, img_or_path)
+    return await _upload_jpeg_with_gemini(data)
+
+@_gemini_retry
+async def generate_with_gemini(parts):
+    """Call Gemini asynchronously, bounded by GEMINI_CONCURRENCY"""
+    async with _gemini_semaphore:
+        return await gemini_model.generate_content_async(parts)
+
 def extract_cheque_number_from_micr(micr_code):
     """Extract 6-digit cheque number from MICR code (first segment)"""
     if not micr_code:
         return ""
     
-    parts = re.findall(r'[⑈⑆]\s*(\d+)\s*[⑈⑆]', micr_code)
+    first_segment = _MICR_RE.search(micr_code)
     
-    if len(parts) >= 1:
-        cheque_num = parts[0]
-        print(f"✓ Extracted cheque number from MICR: {cheque_num}")
+    if first_segment:
+        cheque_num = first_segment.group(1)
+        logger.info("✓ Extracted cheque number from MICR: %s", cheque_num)
         return cheque_num
     
-    fallback = re.findall(r'\b\d{6}\b', micr_code)
+    fallback = _MICR_FALLBACK_RE.search(micr_code)
     if fallback:
-        return fallback[0]
+        return fallback.group(0)
     
     return ""
 
@@ -62,32 +418,19 @@ def format_indian_currency(amount_str):
     if not amount_str:
         return ""
     
-    digits = re.sub(r'[^\d]', '', str(amount_str))
+    digits = _NON_DIGIT_RE.sub('', str(amount_str))
     if not digits:
         return ""
     
-    amount = int(digits)
-    s = str(amount)
-    if len(s) > 3:
-        last_three = s[-3:]
-        remaining = s[:-3]
-        formatted = ""
-        for i in range(len(remaining) - 1, -1, -1):
-            formatted = remaining[i] + formatted
-            if i > 0 and (len(remaining) - i) % 2 == 0:
-                formatted = ',' + formatted
-        s = formatted + ',' + last_three
+    s = str(int(digits))
+    last_three, remaining = s[-3:], s[:-3]
+    if remaining:
+        s = _INDIAN_GROUP_RE.sub(r'\1,', remaining) + ',' + last_three
     return f"₹ {s}/-"
 
 # ==================== CHEQUE PROCESSING ====================
 
-def extract_cheque_with_gemini(image_path):
-    """Extract cheque data using Gemini AI"""
-    print(f"💳 Processing cheque with Gemini: {image_path}")
-    
-    img = Image.open(image_path)
-    
-    prompt = """You are an expert at reading bank cheques. Analyze this cheque image and extract:
+_CHEQUE_PROMPT = """You are an expert at reading bank cheques. Analyze this cheque image and extract:
 
 **MANDATORY FIELDS:**
 1. **Bank Name**: Name of the bank (e.g., "State Bank of India", "HDFC Bank")
@@ -130,18 +473,22 @@ Return ONLY valid JSON (no markdown, no explanations):
   "bank_address": "",
   "branch_code": ""
 }"""
+
+async def extract_cheque_with_gemini(img_or_path):
+    """Extract cheque data using Gemini AI"""
+    logger.info("💳 Processing cheque with Gemini: %s", describe_image(img_or_path))
     
     try:
-        response = gemini_model.generate_content([prompt, img])
+        file_ref = await upload_with_gemini(img_or_path)
+        response = await generate_with_gemini([_CHEQUE_PROMPT, file_ref])
         json_text = response.text.strip()
         
-        if json_text.startswith('```json'):
-            json_text = json_text.split('```json')[1].split('```')[0].strip()
-        elif json_text.startswith('```'):
-            json_text = json_text.split('```')[1].split('```')[0].strip()
+        fenced = _FENCE_RE.search(json_text)
+        if fenced:
+            json_text = fenced.group(1)
         
-        extracted = json.loads(json_text)
-        print(f"✓ Gemini extracted JSON: {extracted}")
+        extracted = orjson.loads(json_text)
+        logger.debug("✓ Gemini extracted JSON: %s", extracted)
         
         micr_code = extracted.get('micr_code', '')
         cheque_number = extract_cheque_number_from_micr(micr_code)
@@ -169,27 +516,19 @@ Return ONLY valid JSON (no markdown, no explanations):
             'extracted_at': datetime.now().isoformat()
         }
         
-        print(f"✓ Extracted Account Holder: {result['account_holder_name']}")
+        logger.info("✓ Extracted Account Holder: %s", result['account_holder_name'])
         
        
         
         return result
         
     except Exception as e:
-        print(f"❌ Gemini error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Gemini error: %s", e)
         return None
 
 # ==================== PASSBOOK PROCESSING ====================
 
-def extract_passbook_with_gemini(image_path):
-    """Extract bank passbook COVER PAGE details only"""
-    print(f"📖 Processing bank passbook cover page: {image_path}")
-    
-    img = Image.open(image_path)
-    
-    prompt = """You are an expert at reading bank passbook cover pages. Analyze this passbook FIRST PAGE/COVER PAGE image and extract ONLY the account holder information.
+_PASSBOOK_PROMPT = """You are an expert at reading bank passbook cover pages. Analyze this passbook FIRST PAGE/COVER PAGE image and extract ONLY the account holder information.
 
 **IMPORTANT:** Extract ONLY account holder details. DO NOT extract transaction data.
 
@@ -247,17 +586,21 @@ Return ONLY valid JSON (no markdown, no explanations):
   "date_of_issue": "",
   "date_of_activation": ""
 }"""
+
+async def extract_passbook_with_gemini(img_or_path):
+    """Extract bank passbook COVER PAGE details only"""
+    logger.info("📖 Processing bank passbook cover page: %s", describe_image(img_or_path))
     
     try:
-        response = gemini_model.generate_content([prompt, img])
+        file_ref = await upload_with_gemini(img_or_path)
+        response = await generate_with_gemini([_PASSBOOK_PROMPT, file_ref])
         json_text = response.text.strip()
         
-        if json_text.startswith('```json'):
-            json_text = json_text.split('```json')[1].split('```')[0].strip()
-        elif json_text.startswith('```'):
-            json_text = json_text.split('```')[1].split('```')[0].strip()
+        fenced = _FENCE_RE.search(json_text)
+        if fenced:
+            json_text = fenced.group(1)
         
-        extracted = json.loads(json_text)
+        extracted = orjson.loads(json_text)
         
         result = {
             'document_type': 'passbook',
@@ -284,27 +627,19 @@ Return ONLY valid JSON (no markdown, no explanations):
             'extracted_at': datetime.now().isoformat()
         }
         
-        print(f"✓ Extracted SWIFT: {result['swift_code']}")
-        print(f"✓ Extracted Customer: {result['customer_name']}")
-        print(f"✓ Extracted Bank Name: {result['bank_name']}")
+        logger.info("✓ Extracted SWIFT: %s", result['swift_code'])
+        logger.info("✓ Extracted Customer: %s", result['customer_name'])
+        logger.info("✓ Extracted Bank Name: %s", result['bank_name'])
         
         return result
         
     except Exception as e:
-        print(f"❌ Gemini error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Gemini error: %s", e)
         return None
 
 # ==================== GST PROCESSING ====================
 
-def extract_gst_with_gemini(image_path):
-    """Extract GST Certificate data using Gemini AI"""
-    print(f"📄 Processing GST Certificate with Gemini: {image_path}")
-    
-    img = Image.open(image_path)
-    
-    prompt = """You are an expert at reading GST Registration Certificates from India. Analyze this GST certificate image and extract ALL fields accurately.
+_GST_PROMPT = """You are an expert at reading GST Registration Certificates from India. Analyze this GST certificate image and extract ALL fields accurately.
 
 **MANDATORY FIELDS TO EXTRACT:**
 
@@ -355,31 +690,46 @@ Return ONLY valid JSON (no markdown):
   "office": "",
   "issue_date": ""
 }"""
+
+def build_gst_address(fields):
+    """Join the GST address components into a single display line"""
+    address_parts = []
+    if fields.get('floor_number'):
+        address_parts.append(f"Floor: {fields['floor_number']}")
+    if fields.get('building_number'):
+        address_parts.append(f"Building: {fields['building_number']}")
+    if fields.get('premises_name'):
+        address_parts.append(fields['premises_name'])
+    if fields.get('road_street'):
+        address_parts.append(fields['road_street'])
+    if fields.get('locality'):
+        address_parts.append(fields['locality'])
+    
+    return ', '.join(filter(None, address_parts))
+
+def merge_gst_pages(results):
+    """Merge per-page GST results, rebuilding full_address from the merged components"""
+    merged = merge_first_non_empty(results)
+    if merged:
+        merged['full_address'] = build_gst_address(merged)
+    return merged
+
+async def extract_gst_with_gemini(img_or_path):
+    """Extract GST Certificate data using Gemini AI"""
+    logger.info("📄 Processing GST Certificate with Gemini: %s", describe_image(img_or_path))
     
     try:
-        response = gemini_model.generate_content([prompt, img])
+        file_ref = await upload_with_gemini(img_or_path)
+        response = await generate_with_gemini([_GST_PROMPT, file_ref])
         json_text = response.text.strip()
         
-        if json_text.startswith('```json'):
-            json_text = json_text.split('```json')[1].split('```')[0].strip()
-        elif json_text.startswith('```'):
-            json_text = json_text.split('```')[1].split('```')[0].strip()
-        
-        extracted = json.loads(json_text)
+        fenced = _FENCE_RE.search(json_text)
+        if fenced:
+            json_text = fenced.group(1)
         
-        address_parts = []
-        if extracted.get('floor_number'):
-            address_parts.append(f"Floor: {extracted['floor_number']}")
-        if extracted.get('building_number'):
-            address_parts.append(f"Building: {extracted['building_number']}")
-        if extracted.get('premises_name'):
-            address_parts.append(extracted['premises_name'])
-        if extracted.get('road_street'):
-            address_parts.append(extracted['road_street'])
-        if extracted.get('locality'):
-            address_parts.append(extracted['locality'])
+        extracted = orjson.loads(json_text)
         
-        full_address = ', '.join(filter(None, address_parts))
+        full_address = build_gst_address(extracted)
         
         result = {
             'document_type': 'gst_certificate',
@@ -407,14 +757,12 @@ Return ONLY valid JSON (no markdown):
             'extracted_at': datetime.now().isoformat()
         }
         
-        print(f"✓ Extracted GSTIN: {result['registration_number']}")
+        logger.info("✓ Extracted GSTIN: %s", result['registration_number'])
         
         return result
         
     except Exception as e:
-        print(f"❌ Gemini error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Gemini error: %s", e)
         return None
 
 # ==================== ROUTES ====================
@@ -447,14 +795,21 @@ def api_status():
         }
     })
 
-@app.route('/api/extract/cheque', methods=['POST'])
-def process_cheque():
+def _unsupported_file_type():
+    return jsonify({
+        'success': False,
+        'error': 'Unsupported file type',
+        'message': 'Please upload a JPG, PNG, WEBP or PDF file'
+    }), 415
+
+def _process(doc_type, extract_fn, merge_fn, upload_prompt, failure_message, success_message):
+    """Shared upload -> cache -> extract -> respond flow behind every /api/extract route"""
     try:
         if 'file' not in request.files:
             return jsonify({
                 'success': False,
                 'error': 'No file provided',
-                'message': 'Please upload a cheque image or PDF'
+                'message': upload_prompt
             }), 400
         
         file = request.files['file']
@@ -466,155 +821,100 @@ def process_cheque():
                 'message': 'No file selected'
             }), 400
         
-        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        if filepath.lower().endswith('.pdf'):
-            images = convert_from_path(filepath, dpi=300)
-            temp_img = f"{filepath}_page1.jpg"
-            images[0].save(temp_img, 'JPEG')
-            data = extract_cheque_with_gemini(temp_img)
-            os.remove(temp_img)
-        else:
-            data = extract_cheque_with_gemini(filepath)
-        
-        os.remove(filepath)
+        ext = os.path.splitext(file.filename)[1].lower()
+        declared = file.mimetype
+        if ext not in ALLOWED_EXTENSIONS or (declared not in UNKNOWN_MIMETYPES and declared not in ALLOWED_MIMETYPES):
+            return _unsupported_file_type()
+        
+        buf = io.BytesIO()
+        file.stream.seek(0)
+        shutil.copyfileobj(file.stream, buf, length=1024 * 1024)
+        file_type = sniff_file_type(buf.getbuffer()[:12].tobytes())
+        if file_type is None:
+            return _unsupported_file_type()
+        
+        digest = hashlib.sha256(buf.getbuffer()).hexdigest()
+        data = get_cached_result(doc_type, digest)
+        failed_pages = []
+        
+        if data is None:
+            if file_type == 'application/pdf':
+                pages = render_pdf_pages(buf, file.filename)
+            else:
+                buf.seek(0)
+                pages = [Image.open(buf)]
+            
+            logger.info("📥 Extracting %s from %s (%d page(s))", doc_type, file.filename, len(pages))
+            results = run_async(extract_pages(extract_fn, pages))
+            failed_pages = [number for number, result in enumerate(results, 1) if not result]
+            
+            # One page (image or single-page PDF) keeps the plain dict shape;
+            # only multi-page PDFs are merged
+            if len(failed_pages) == len(results):
+                data = None
+            elif len(pages) > 1:
+                data = merge_fn(results)
+            else:
+                data = results[0]
+            
+            # Partial results are returned but never cached, so a retry re-extracts
+            if data and not failed_pages:
+                set_cached_result(doc_type, digest, data)
         
         if not data:
             return jsonify({
                 'success': False,
                 'error': 'Extraction failed',
-                'message': 'Failed to extract cheque data. Please ensure the image is clear and readable.'
+                'message': failure_message
             }), 500
         
-        return jsonify({
+        response = {
             'success': True,
-            'message': 'Cheque data extracted successfully',
+            'message': success_message,
             'data': data
-        })
+        }
+        if failed_pages:
+            response['partial'] = True
+            response['failed_pages'] = failed_pages
+        return jsonify(response)
         
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Failed to process %s upload", doc_type)
         return jsonify({
             'success': False,
             'error': 'Server error',
             'message': str(e)
         }), 500
 
+@app.route('/api/extract/cheque', methods=['POST'])
+def process_cheque():
+    return _process(
+        'cheque', extract_cheque_with_gemini, collect_cheques,
+        upload_prompt='Please upload a cheque image or PDF',
+        failure_message='Failed to extract cheque data. Please ensure the image is clear and readable.',
+        success_message='Cheque data extracted successfully'
+    )
+
 @app.route('/api/extract/gst', methods=['POST'])
 def process_gst():
-    try:
-        if 'file' not in request.files:
-            return jsonify({
-                'success': False,
-                'error': 'No file provided',
-                'message': 'Please upload a GST certificate image or PDF'
-            }), 400
-        
-        file = request.files['file']
-        
-        if file.filename == '':
-            return jsonify({
-                'success': False,
-                'error': 'Empty filename',
-                'message': 'No file selected'
-            }), 400
-        
-        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        if filepath.lower().endswith('.pdf'):
-            images = convert_from_path(filepath, dpi=300)
-            temp_img = f"{filepath}_page1.jpg"
-            images[0].save(temp_img, 'JPEG')
-            data = extract_gst_with_gemini(temp_img)
-            os.remove(temp_img)
-        else:
-            data = extract_gst_with_gemini(filepath)
-        
-        os.remove(filepath)
-        
-        if not data:
-            return jsonify({
-                'success': False,
-                'error': 'Extraction failed',
-                'message': 'Failed to extract GST data. Please ensure the certificate is clear and readable.'
-            }), 500
-        
-        return jsonify({
-            'success': True,
-            'message': 'GST certificate data extracted successfully',
-            'data': data
-        })
-        
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({
-            'success': False,
-            'error': 'Server error',
-            'message': str(e)
-        }), 500
+    return _process(
+        'gst', extract_gst_with_gemini, merge_gst_pages,
+        upload_prompt='Please upload a GST certificate image or PDF',
+        failure_message='Failed to extract GST data. Please ensure the certificate is clear and readable.',
+        success_message='GST certificate data extracted successfully'
+    )
 
 @app.route('/api/extract/passbook', methods=['POST'])
 def process_passbook():
-    try:
-        if 'file' not in request.files:
-            return jsonify({
-                'success': False,
-                'error': 'No file provided',
-                'message': 'Please upload a passbook image or PDF'
-            }), 400
-        
-        file = request.files['file']
-        
-        if file.filename == '':
-            return jsonify({
-                'success': False,
-                'error': 'Empty filename',
-                'message': 'No file selected'
-            }), 400
-        
-        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        if filepath.lower().endswith('.pdf'):
-            images = convert_from_path(filepath, dpi=300)
-            temp_img = f"{filepath}_page1.jpg"
-            images[0].save(temp_img, 'JPEG')
-            data = extract_passbook_with_gemini(temp_img)
-            os.remove(temp_img)
-        else:
-            data = extract_passbook_with_gemini(filepath)
-        
-        os.remove(filepath)
-        
-        if not data:
-            return jsonify({
-                'success': False,
-                'error': 'Extraction failed',
-                'message': 'Failed to extract passbook data. Please ensure the cover page is clear and readable.'
-            }), 500
-        
-        return jsonify({
-            'success': True,
-            'message': 'Passbook data extracted successfully',
-            'data': data
-        })
-        
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({
-            'success': False,
-            'error': 'Server error',
-            'message': str(e)
-        }), 500
-
+    return _process(
+        'passbook', extract_passbook_with_gemini, merge_first_non_empty,
+        upload_prompt='Please upload a passbook image or PDF',
+        failure_message='Failed to extract passbook data. Please ensure the cover page is clear and readable.',
+        success_message='Passbook data extracted successfully'
+    )
+
+# Local development only; in production run: gunicorn -c gunicorn_conf.py app:app
 if __name__ == '__main__':
+    warm_up_gemini()
     port = int(os.environ.get('PORT', 10000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,27 @@
+"""
+Gunicorn configuration for the Document Extractor API
+Run with: gunicorn -c gunicorn_conf.py app:app
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+
+# Threaded workers: a request waiting on Gemini only occupies one thread,
+# so other uploads keep being served in parallel
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 120
+
+# Each worker must import the app itself: the Gemini event loop thread and
+# its gRPC channel do not survive fork()
+preload_app = False
+
+
+def post_worker_init(worker):
+    # Open this worker's Gemini generate and Files API connections now so the
+    # first upload doesn't pay for discovery and the TCP/TLS handshakes
+    from app import warm_up_gemini
+    warm_up_gemini()